@@ -0,0 +1,22 @@
+def merge_reads(requests, max_count):
+    """ Merge overlapping or adjacent reads into as few reads as possible.
+
+    Args:
+        requests (list): (address, count, index) tuple for each read.
+        max_count (int): Most coils/registers a single read may cover.
+
+    Returns:
+        list: (address, count, requests) tuple for each combined read.
+    """
+    combined = []
+    for request in sorted(requests):
+        address, count, _ = request
+        if combined:
+            start, span, members = combined[-1]
+            end = max(start + span, address + count)
+            if address <= start + span and end - start <= max_count:
+                members.append(request)
+                combined[-1] = (start, end - start, members)
+                continue
+        combined.append((address, count, [request]))
+    return combined
@@ -1,13 +1,16 @@
 import minimalmodbus
 from enum import Enum
-from threading import Event, Lock
+from threading import BoundedSemaphore, Event, Lock
 from time import sleep
 
 from nio.block.base import Block
 from nio.block.mixins.retry.retry import Retry
 from nio.signal.base import Signal
 from nio.properties import StringProperty, IntProperty, FloatProperty, \
-    Property, VersionProperty, SelectProperty, PropertyHolder, ObjectProperty
+    Property, VersionProperty, SelectProperty, PropertyHolder, \
+    ObjectProperty, BoolProperty
+
+from .modbus_reads import merge_reads
 
 
 class FunctionName(Enum):
@@ -21,6 +24,23 @@ class FunctionName(Enum):
     write_multiple_holding_registers = 16
 
 
+# minimalmodbus method used for each function code
+FUNCTION_METHODS = {
+    1: 'read_bit',
+    2: 'read_bit',
+    5: 'write_bit',
+    15: 'write_bit',
+    3: 'read_registers',
+    4: 'read_registers',
+    6: 'write_register',
+    16: 'write_registers'
+}
+READ_REGISTERS_CODES = frozenset((3, 4))
+# Most registers the Modbus spec allows in a single read request
+MAX_READ_REGISTERS = 125
+WRITE_CODES = frozenset((5, 6, 15, 16))
+
+
 class PortConfig(PropertyHolder):
     baudrate = IntProperty(title='Baud Rate', default=19200, order=21)
     parity = StringProperty(title='Parity (N, E, O)', default='N', order=23)
@@ -57,87 +77,188 @@ class ModbusRTU(Retry, Block):
                                  default=PortConfig(),
                                  advanced=True)
     timeout = FloatProperty(title='Timeout', default='0.05', advanced=True)
+    combine_reads = BoolProperty(title='Combine Adjacent Reads',
+                                 default=False,
+                                 advanced=True)
+    max_read_registers = IntProperty(title='Max Registers Per Read',
+                                     default=MAX_READ_REGISTERS,
+                                     advanced=True)
 
 
     def __init__(self):
         super().__init__()
         self._client = None
-        self._process_lock = Lock()
+        self._bus_lock = Lock()
+        self._function_code = None
+        self._count = None
         self._modbus_function = None
-        self._num_locks = 0
+        self._modbus_call = None
+        self._fixed_address = None
+        self._fixed_value = None
+        self._value_is_fixed = False
+        self._combine_reads = False
+        self._max_read_registers = MAX_READ_REGISTERS
         self._max_locks = 5
+        self._lock_slots = BoundedSemaphore(self._max_locks)
 
     def configure(self, context):
         super().configure(context)
+        # These don't use the incoming signal so look them up only once
+        self._function_code = self.function_name().value
+        self._count = self.count()
+        self._modbus_function = FUNCTION_METHODS.get(self._function_code)
         self._connect()
-        self._modbus_function = \
-            self._function_name_from_code(self.function_name().value)
+        # An address or value without an expression is the same for every
+        # signal, so there is no need to evaluate it again for each one
+        self._fixed_address = None
+        if not _is_expression(context.properties.get('address')):
+            self._fixed_address = self._address(None)
+        self._value_is_fixed = 'value' in context.properties and \
+            not _is_expression(context.properties['value'])
+        self._fixed_value = self.value() if self._value_is_fixed else None
+        # Only register reads can be combined, single bits are read one at a
+        # time by minimalmodbus
+        self._combine_reads = self.combine_reads() and \
+            self._function_code in READ_REGISTERS_CODES
+        self._max_read_registers = max(
+            1, min(self.max_read_registers(), MAX_READ_REGISTERS))
 
     def process_signals(self, signals, input_id='default'):
+        if not signals:
+            return
+        if self._combine_reads:
+            output = self._process_combined_reads(signals)
+        else:
+            output = self._process_each_signal(signals)
+        if output:
+            self.notify_signals(output)
+
+    def _process_each_signal(self, signals):
         output = []
+        append = output.append
+        process_signal = self._process_signal
+        lock_slots = self._lock_slots
         for signal in signals:
-            if self._num_locks >= self._max_locks:
+            if not lock_slots.acquire(blocking=False):
                 self.logger.debug(
                     "Skipping signal; max numbers of signals waiting")
                 continue
-            self._num_locks += 1
-            with self._process_lock:
-                output_signal = self._process_signal(signal)
-                if output_signal:
-                    output.append(output_signal)
-            self._num_locks -= 1
-        if output:
-            self.notify_signals(output)
+            try:
+                output_signal = process_signal(signal)
+            finally:
+                lock_slots.release()
+            if output_signal:
+                append(output_signal)
+        return output
+
+    def _process_combined_reads(self, signals):
+        """Read adjacent registers for all the signals with shared requests"""
+        if not self._lock_slots.acquire(blocking=False):
+            self.logger.debug(
+                "Skipping signals; max numbers of signals waiting")
+            return []
+        try:
+            requests = []
+            for index, signal in enumerate(signals):
+                address = self._address(signal)
+                if address is not None:
+                    requests.append((address, self._count, index))
+            output = [None] * len(signals)
+            for address, count, members in \
+                    merge_reads(requests, self._max_read_registers):
+                self._execute_combined_read(address, count, members, output)
+        finally:
+            self._lock_slots.release()
+        return [signal for signal in output if signal]
+
+    def _execute_combined_read(self, address, count, members, output):
+        """Make one read and split the response between the members"""
+        params = {
+            'functioncode': self._function_code,
+            'registeraddress': address,
+            'numberOfRegisters': count
+        }
+        with self._bus_lock:
+            response = self.execute_with_retry(self._call, params=params)
+        if not response:
+            return
+        for member_address, member_count, index in members:
+            start = member_address - address
+            output[index] = self._process_response(
+                response[start:start + member_count],
+                dict(params,
+                     registeraddress=member_address,
+                     numberOfRegisters=member_count))
 
     def _process_signal(self, signal):
         params = self._prepare_params(signal)
-        return self.execute_with_retry(self._execute, params=params)
+        # Only hold the lock while talking on the serial bus, preparing the
+        # params for the next signal doesn't need to wait on it
+        with self._bus_lock:
+            return self.execute_with_retry(self._execute, params=params)
 
     def _connect(self):
         self.logger.debug('Connecting to modbus')
-        minimalmodbus.BAUDRATE = self.port_config().baudrate()
-        minimalmodbus.PARITY = self.port_config().parity()
-        minimalmodbus.BYTESIZE = self.port_config().bytesize()
-        minimalmodbus.STOPBITS = self.port_config().stopbits()
-        minimalmodbus.TIMEOUT = self.timeout()
-        self._client = minimalmodbus.Instrument(self.port_config().port(),
+        port_config = self.port_config()
+        self._client = minimalmodbus.Instrument(port_config.port(),
                                                 self.slave_address())
+        # Configure this block's port directly rather than through the
+        # minimalmodbus module defaults, which are shared by every block
+        serial = self._client.serial
+        serial.baudrate = port_config.baudrate()
+        serial.parity = port_config.parity()
+        serial.bytesize = port_config.bytesize()
+        serial.stopbits = port_config.stopbits()
+        serial.timeout = self.timeout()
+        # Bind the client method once instead of looking it up on each call
+        self._modbus_call = getattr(self._client, self._modbus_function)
+        self._set_low_latency()
         self.logger.debug(self._client)
         self.logger.debug('Succesfully connected to modbus')
 
+    def _set_low_latency(self):
+        """USB serial adapters buffer reads for several ms by default"""
+        if not self._client.serial.is_open:
+            # minimalmodbus hands back the cached port that _close closed
+            # before a retry, and there is no open file to configure
+            return
+        try:
+            self._client.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            # Not supported on every platform and serial driver
+            self.logger.debug(
+                "Serial port does not support low latency mode", exc_info=True)
+
     def _execute(self, params, retry=False):
-        self.logger.debug('Executing Modbus function \'{}\' with params: {}, '
-                          'is_retry: {}'.format(self._modbus_function,
-                                                params, retry))
-        response = getattr(self._client, self._modbus_function)(**params)
-        self.logger.debug('Modbus function returned: {}'.format(response))
+        response = self._call(params, retry)
         return self._process_response(response, params)
 
-    def _function_name_from_code(self, code):
-        return {
-            1: 'read_bit',
-            2: 'read_bit',
-            5: 'write_bit',
-            15: 'write_bit',
-            3: 'read_registers',
-            4: 'read_registers',
-            6: 'write_register',
-            16: 'write_registers'
-        }.get(code)
+    def _call(self, params, retry=False):
+        self.logger.debug('Executing Modbus function \'%s\' with params: %s, '
+                          'is_retry: %s', self._modbus_function, params, retry)
+        response = self._modbus_call(**params)
+        self.logger.debug('Modbus function returned: %s', response)
+        return response
 
     def _prepare_params(self, signal):
-        params = {}
-        params['functioncode'] = self.function_name().value
-        params['registeraddress'] = self._address(signal)
-        if self.function_name().value in [3, 4]:
-            params['numberOfRegisters'] = self.count()
-        elif self.function_name().value in [5, 6, 15, 16]:
-            try:
-                params['value'] = self.value(signal)
-            except:
-                raise Exception('Invalid configuration of `value` property')
+        params = {
+            'functioncode': self._function_code,
+            'registeraddress': self._address(signal)
+        }
+        if self._function_code in READ_REGISTERS_CODES:
+            params['numberOfRegisters'] = self._count
+        elif self._function_code in WRITE_CODES:
+            params['value'] = self._value(signal)
         return params
 
+    def _value(self, signal):
+        if self._value_is_fixed:
+            return self._fixed_value
+        try:
+            return self.value(signal)
+        except:
+            raise Exception('Invalid configuration of `value` property')
+
     def _process_response(self, response, params):
         if not response:
             return
@@ -148,6 +269,8 @@ class ModbusRTU(Retry, Block):
         return signal
 
     def _address(self, signal):
+        if self._fixed_address is not None:
+            return self._fixed_address
         try:
             return int(self.address(signal))
         except:
@@ -167,3 +290,7 @@ class ModbusRTU(Retry, Block):
         except:
             self.logger.warning(
                 "Failed to manually close serial connection", exc_info=True)
+
+
+def _is_expression(value):
+    return isinstance(value, str) and '{{' in value
@@ -1,15 +1,21 @@
 import logging
 import pymodbus.client.sync
+import socket
+from collections import defaultdict
 from enum import Enum
 from time import sleep
 
+from pymodbus.exceptions import ConnectionException
+
 from nio.block.base import Block
 from nio.properties import IntProperty, Property, VersionProperty, \
-    SelectProperty, FloatProperty
+    SelectProperty, FloatProperty, BoolProperty
 from nio.block.mixins.limit_lock.limit_lock import LimitLock
 from nio.block.mixins.retry.retry import Retry
 from nio.block.mixins.enrich.enrich_signals import EnrichSignals
 
+from .modbus_reads import merge_reads
+
 
 class FunctionName(Enum):
     read_coils = 'read_coils'
@@ -22,6 +28,63 @@ class FunctionName(Enum):
     write_multiple_holding_registers = 'write_registers'
 
 
+# Name of the keyword argument each write function takes its value(s) as
+WRITE_PARAMS = {
+    'write_coil': 'value',
+    'write_register': 'value',
+    'write_coils': 'values',
+    'write_registers': 'values',
+}
+
+
+# Most coils/registers the Modbus spec allows in a single read request
+MAX_READ_COUNTS = {
+    'read_coils': 2000,
+    'read_discrete_inputs': 2000,
+    'read_holding_registers': 125,
+    'read_input_registers': 125,
+}
+
+# Probe an idle connection after 30 seconds, every 10 seconds, 3 times,
+# rather than after the usual OS default of two hours
+KEEPALIVE_OPTIONS = [
+    (getattr(socket, name), value)
+    for name, value in (('TCP_KEEPIDLE', 30),
+                        ('TCP_KEEPINTVL', 10),
+                        ('TCP_KEEPCNT', 3))
+    if hasattr(socket, name)
+]
+
+
+EXCEPTION_DETAILS = {
+    1: 'Function code received in the query is not '
+       'recognized or allowed by slave',
+    2: 'Data address of some or all the required entities '
+       'are not allowed or do not exist in slave',
+    3: 'Value is not accepted by slave',
+    4: 'Unrecoverable error occurred while slave was '
+       'attempting to perform requested action',
+    5: 'Slave has accepted request and is processing it, '
+       'but a long duration of time is required. '
+       'This response is returned to prevent a '
+       'timeout error from occurring in the master. '
+       'Master can next issue a Poll Program Complete '
+       'message to determine if processing is completed',
+    6: 'Slave engaged in processing a long-duration command. '
+       'Master should retry later',
+    7: 'Slave cannot perform the programming functions. '
+       'Master should request diagnostic '
+       'or error information from slave',
+    8: 'Slave detected a parity error in memory. '
+       'Master can retry the request, '
+       'but service may be required on the slave device',
+    10: 'Specialized for Modbus gateways. '
+        'Indicates a misconfigured gateway',
+    11: 'Specialized for Modbus gateways. '
+        'Sent when slave fails to respond',
+}
+
+
 class ModbusTCP(LimitLock, EnrichSignals, Retry, Block):
 
     """ Communicate with a device using Modbus over TCP.
@@ -46,10 +109,20 @@ class ModbusTCP(LimitLock, EnrichSignals, Retry, Block):
                         order=15)
     unit_id = IntProperty(title='Unit ID', default=1, order=12)
     timeout = FloatProperty(title='Timeout', default=1, advanced=True)
+    combine_reads = BoolProperty(title='Combine Adjacent Reads',
+                                 default=False,
+                                 advanced=True)
+    max_read_registers = IntProperty(
+        title='Max Registers Per Read',
+        default=MAX_READ_COUNTS['read_holding_registers'],
+        advanced=True)
 
     def __init__(self):
         super().__init__()
         self._clients = {}
+        self._client_methods = {}
+        # Last socket of each client that has had its options set
+        self._sockets = {}
 
     def configure(self, context):
         super().configure(context)
@@ -68,47 +141,141 @@ class ModbusTCP(LimitLock, EnrichSignals, Retry, Block):
         self._connect(host, port)
 
     def process_signals(self, signals):
+        if not signals:
+            # Nothing to send, so don't take up one of the lock slots
+            return
         try:
             self.execute_with_lock(
                 self._locked_process_signals, 5, signals=signals
             )
-        except:
+        except Exception:
             # a warning has already been logged by LimitLock mixin
             pass
 
     def _locked_process_signals(self, signals):
-        output = []
-        for signal in signals:
-            output_signal = self._process_signal(signal)
-            if output_signal:
-                output.append(output_signal)
+        if self.combine_reads():
+            output_signals = self._process_combined_reads(signals)
+        else:
+            output_signals = map(self._process_signal, signals)
+        output = [signal for signal in output_signals if signal]
         if output:
             self.notify_signals(output)
 
-    def _process_signal(self, signal):
-        modbus_function = self.function_name(signal).value
+    def _process_combined_reads(self, signals):
+        ''' Process signals, sharing one request between adjacent reads '''
+        output = [None] * len(signals)
+        reads = defaultdict(list)
+        for index, signal in enumerate(signals):
+            modbus_function = self.function_name(signal).value
+            request = self._read_request(modbus_function, signal)
+            if request is None:
+                # Make any pending reads first so that reads and writes still
+                # happen in the same order as the incoming signals
+                self._execute_reads(signals, reads, output)
+                reads.clear()
+                output[index] = self._process_signal(signal, modbus_function)
+            else:
+                key, address, count = request
+                reads[key].append((address, count, index))
+        self._execute_reads(signals, reads, output)
+        return output
+
+    def _read_request(self, modbus_function, signal):
+        ''' Return the (key, address, count) of a read, None otherwise '''
+        if modbus_function not in MAX_READ_COUNTS:
+            return
+        try:
+            key = (self.host(signal), self.port(signal),
+                   self.unit_id(signal), modbus_function)
+            return key, self.address(signal), self.count(signal)
+        except Exception:
+            # Let the regular signal processing handle and log the error
+            return
+
+    def _execute_reads(self, signals, reads, output):
+        for key, requests in reads.items():
+            modbus_function = key[3]
+            max_count = MAX_READ_COUNTS[modbus_function]
+            if modbus_function.endswith('registers'):
+                # Some devices can't answer reads as large as the spec allows
+                max_count = max(1, min(max_count, self.max_read_registers()))
+            combined_reads = merge_reads(requests, max_count)
+            for address, count, members in combined_reads:
+                self._execute_combined_read(
+                    signals, output, key, address, count, members)
+
+    def _execute_combined_read(self, signals, output, key,
+                               address, count, requests):
+        ''' Make one read and split the response between the requests '''
+        host, port, unit, modbus_function = key
+        params = {'address': address, 'count': count, 'unit': unit}
+        try:
+            result = self.execute_with_retry(
+                self._call,
+                host=host,
+                port=port,
+                modbus_function=modbus_function,
+                params=params)
+        except Exception:
+            self.logger.exception(
+                'Failed to execute on host: {}'.format(host))
+            for _, _, index in requests:
+                output[index] = self.get_output_signal({}, signals[index])
+            return
+        if not result:
+            return
+        for request_address, request_count, index in requests:
+            results = dict(vars(result), params={
+                'address': request_address,
+                'count': request_count,
+                'unit': unit})
+            start = request_address - address
+            for values in ('bits', 'registers'):
+                if values in results:
+                    results[values] = \
+                        results[values][start:start + request_count]
+            # Report the byte count a single read of this slice would have
+            if 'byte_count' in results:
+                if 'registers' in results:
+                    results['byte_count'] = 2 * request_count
+                else:
+                    results['byte_count'] = (request_count + 7) // 8
+            output[index] = self._output_signal(results, signals[index])
+
+    def _process_signal(self, signal, modbus_function=None):
+        if modbus_function is None:
+            modbus_function = self.function_name(signal).value
         params = self._prepare_params(modbus_function, signal)
-        params['address'] = self.address(signal)
-        params['unit'] = self.unit_id(signal)
+        address = self.address(signal)
         if modbus_function is None or \
-                self.address(signal) is None or \
+                address is None or \
                 params is None:
             # A warning method has already been logged if we get here
             return
+        params['address'] = address
+        params['unit'] = self.unit_id(signal)
+        host = None
         try:
+            host = self.host(signal)
+            port = self.port(signal)
             return self.execute_with_retry(
                 self._execute,
                 signal=signal,
+                host=host,
+                port=port,
                 modbus_function=modbus_function,
                 params=params)
-        except:
+        except Exception:
             self.logger.exception(
-                'Failed to execute on host: {}'.format(self.host(signal)))
+                'Failed to execute on host: {}'.format(host))
             return self.get_output_signal({}, signal)
 
     def stop(self):
-        for client in self._clients:
-            self._clients[client].close()
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+        self._client_methods.clear()
+        self._sockets.clear()
         super().stop()
 
     def _connect(self, host=None, port=502):
@@ -116,95 +283,119 @@ class ModbusTCP(LimitLock, EnrichSignals, Retry, Block):
         if host:
             self._connect_to_host(host, port)
         else:
-            for client in self._clients:
-                host, port = client.split(":")
-                self._connect_to_host(host, int(port))
+            for host, port in list(self._clients):
+                self._reconnect(host, port)
 
     def _connect_to_host(self, host, port):
-        self.logger.debug('Connecting to modbus host: {}'.format(host))
+        self.logger.debug('Connecting to modbus host: %s', host)
         client = pymodbus.client.sync.ModbusTcpClient(host,
                                                       port=port,
                                                       timeout=self.timeout())
-        self._clients['{}:{}'.format(host,port)] = client
-        self.logger.debug(
-            'Succesfully connected to modbus host: {}'.format(host))
+        self._clients[(host, port)] = client
+        # Look up the client's function methods once instead of per request
+        self._client_methods[(host, port)] = {
+            function.value: getattr(client, function.value)
+            for function in FunctionName}
+        self.logger.debug('Succesfully connected to modbus host: %s', host)
+        return client
+
+    def _reconnect(self, host, port):
+        ''' Close an existing client's socket so the next request reopens it '''
+        client = self._clients.get((host, port))
+        if client is None:
+            return self._connect_to_host(host, port)
+        self.logger.debug('Reconnecting to modbus host: %s', host)
+        client.close()
+        return client
+
+    def _configure_new_socket(self, host, port, client):
+        ''' Set our options on the client's socket if it hasn't had them '''
+        sock = client.socket
+        if sock is not None and sock is not self._sockets.get((host, port)):
+            self._configure_socket(sock)
+            self._sockets[(host, port)] = sock
+
+    def _configure_socket(self, sock):
+        ''' Tune the socket for small request/response round trips '''
+        try:
+            # Requests are tiny and always wait on a response, so don't let
+            # Nagle's algorithm hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Let the OS notice a device that has gone away between polls
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in KEEPALIVE_OPTIONS:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError:
+            self.logger.warning('Failed to set socket options', exc_info=True)
 
     def _client(self, host, port):
-        if '{}:{}'.format(host,port) not in self._clients:
-            self._connect(host, port)
-        return self._clients['{}:{}'.format(host,port)]
+        client = self._clients.get((host, port))
+        if client is None:
+            client = self._connect_to_host(host, port)
+        return client
 
-    def _execute(self, signal, modbus_function, params):
-        self.logger.debug(
-            "Execute Modbus function '{}' with params: {}".format(
-                modbus_function, params))
-        result = getattr(self._client(self.host(signal), self.port(signal)),
-                         modbus_function)(**params)
-        self.logger.debug('Modbus function returned: {}'.format(result))
+    def _client_method(self, host, port, modbus_function):
+        methods = self._client_methods.get((host, port))
+        if methods is None:
+            self._connect_to_host(host, port)
+            methods = self._client_methods[(host, port)]
+        return methods[modbus_function]
+
+    def _execute(self, signal, host, port, modbus_function, params):
+        result = self._call(host, port, modbus_function, params)
         if result:
-            results = result.__dict__
-            results["params"] = params
-            signal = self.get_output_signal(results, signal)
-            self._check_exceptions(signal)
-            return signal
+            # Copy so the pymodbus response object itself is left untouched
+            results = dict(vars(result), params=params)
+            return self._output_signal(results, signal)
+
+    def _call(self, host, port, modbus_function, params):
+        self.logger.debug(
+            "Execute Modbus function '%s' with params: %s",
+            modbus_function, params)
+        client = self._client(host, port)
+        # Connect here rather than letting pymodbus open the socket inside the
+        # request, where its options would never get set. Fail straight away
+        # if that doesn't work instead of waiting on pymodbus to try again.
+        if client.socket is None and not client.connect():
+            raise ConnectionException(
+                'Failed to connect to modbus host: {}'.format(host))
+        self._configure_new_socket(host, port, client)
+        result = self._client_method(host, port, modbus_function)(**params)
+        self.logger.debug('Modbus function returned: %s', result)
+        return result
+
+    def _output_signal(self, results, signal):
+        # Add any exception details before the signal is built so that all
+        # of its attributes are set in one go
+        desc = _exception_details(results.get('exception_code'))
+        if desc:
+            results['exception_details'] = desc
+        return self.get_output_signal(results, signal)
 
     def _prepare_params(self, modbus_function, signal):
         try:
-            if modbus_function in ['write_coil', 'write_register']:
-                return {'value': self.value(signal)}
-            elif modbus_function in ['write_coils', 'write_registers']:
-                return {'values': self.value(signal)}
+            write_param = WRITE_PARAMS.get(modbus_function)
+            if write_param:
+                return {write_param: self.value(signal)}
             elif modbus_function.startswith('read'):
                 return {'count': self.count(signal)}
             else:
                 return {}
-        except:
+        except Exception:
             self.logger.warning('Failed to prepare function params',
                                 exc_info=True)
 
     def before_retry(self, *args, **kwargs):
         ''' Reconnect before making retry query. '''
-        self._connect()
-
-    def _check_exceptions(self, signal):
-        ''' Add exception details if the response has an exception code '''
-        code = getattr(signal, 'exception_code', None)
-        desc = None
-        if code and isinstance(code, int):
-            if code == 1:
-                desc = 'Function code received in the query is not ' \
-                       'recognized or allowed by slave'
-            elif code == 2:
-                desc = 'Data address of some or all the required entities ' \
-                       'are not allowed or do not exist in slave'
-            elif code == 3:
-                desc = 'Value is not accepted by slave'
-            elif code == 4:
-                desc = 'Unrecoverable error occurred while slave was ' \
-                       'attempting to perform requested action'
-            elif code == 5:
-                desc = 'Slave has accepted request and is processing it, ' \
-                       'but a long duration of time is required. ' \
-                       'This response is returned to prevent a ' \
-                       'timeout error from occurring in the master. ' \
-                       'Master can next issue a Poll Program Complete ' \
-                       'message to determine if processing is completed'
-            elif code == 6:
-                desc = 'Slave engaged in processing a long-duration command. '\
-                       'Master should retry later'
-            elif code == 7:
-                desc = 'Slave cannot perform the programming functions. ' \
-                       'Master should request diagnostic ' \
-                       'or error information from slave'
-            elif code == 8:
-                desc = 'Slave detected a parity error in memory. ' \
-                       'Master can retry the request, ' \
-                       'but service may be required on the slave device'
-            elif code == 10:
-                desc = 'Specialized for Modbus gateways. ' \
-                       'Indicates a misconfigured gateway'
-            elif code == 11:
-                desc = 'Specialized for Modbus gateways. ' \
-                       'Sent when slave fails to respond'
-        if desc:
-            signal.exception_details = desc
+        host = kwargs.get('host')
+        if host is None:
+            self._connect()
+            return
+        # Only the host that failed needs a new connection, the clients for
+        # any other hosts are still good and can be left alone.
+        self._reconnect(host, kwargs['port'])
+
+
+def _exception_details(code):
+    if isinstance(code, int):
+        return EXCEPTION_DETAILS.get(code)
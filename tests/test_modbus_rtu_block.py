@@ -1,16 +1,14 @@
+from importlib.util import find_spec
 from unittest import skipUnless
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
 from nio.signal.base import Signal
 
-minimalmodbus_available = True
-try:
+minimalmodbus_available = find_spec('minimalmodbus') is not None
+if minimalmodbus_available:
     from ..modbus_rtu_block import ModbusRTU
-except Exception as e:
-    print('Error importing ModbusRTU block: {}'.format(e))
-    minimalmodbus_available = False
 
 
 @skipUnless(minimalmodbus_available, 'minimalmodbus is not available!!')
@@ -34,6 +32,28 @@ class TestModbusRTU(NIOBlockTestCase):
         self.assertEqual(self.last_notified[DEFAULT_TERMINAL][0].values, [42])
         blk.stop()
 
+    @patch('minimalmodbus.Instrument')
+    def test_port_config(self, mock_client):
+        ''' Test that the serial port is set up from the block config '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {
+            'slave_address': 2,
+            'timeout': 0.5,
+            'port_config': {
+                'port': '/dev/ttyS1',
+                'baudrate': 9600,
+                'parity': 'E',
+                'bytesize': 7,
+                'stopbits': 2
+            }
+        })
+        mock_client.assert_called_once_with('/dev/ttyS1', 2)
+        self.assertEqual(blk._client.serial.baudrate, 9600)
+        self.assertEqual(blk._client.serial.parity, 'E')
+        self.assertEqual(blk._client.serial.bytesize, 7)
+        self.assertEqual(blk._client.serial.stopbits, 2)
+        self.assertEqual(blk._client.serial.timeout, 0.5)
+
     @patch('minimalmodbus.Instrument')
     def test_config(self, mock_client):
         ''' Test non-default configuration '''
@@ -44,6 +64,7 @@ class TestModbusRTU(NIOBlockTestCase):
             'address': 1
         })
         self.assertEqual(mock_client.call_count, 1)
+        self.assertEqual(blk._fixed_address, 1)
         blk._client.write_bit.return_value = [42]
         blk.start()
         blk.process_signals([Signal()])
@@ -75,6 +96,112 @@ class TestModbusRTU(NIOBlockTestCase):
             self.last_notified[DEFAULT_TERMINAL][0].values, [42, 43, 44])
         blk.stop()
 
+    @patch('minimalmodbus.Instrument')
+    def test_address_from_signal(self, mock_client):
+        ''' Test that an address expression is evaluated for each signal '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {'address': '{{ $address }}'})
+        self.assertIsNone(blk._fixed_address)
+        blk._client.read_registers.return_value = [42]
+        blk.start()
+        blk.process_signals([Signal({'address': 3}), Signal({'address': 7})])
+        self.assertEqual(blk._client.read_registers.call_count, 2)
+        blk._client.read_registers.assert_called_with(registeraddress=7,
+                                                      functioncode=4,
+                                                      numberOfRegisters=1)
+        blk.stop()
+
+    @patch('minimalmodbus.Instrument')
+    def test_combine_reads(self, mock_client):
+        ''' Test that adjacent register reads share one request '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {
+            'function_name': 'read_holding_registers',
+            'address': '{{ $address }}',
+            'count': 2,
+            'combine_reads': True
+        })
+        blk._client.read_registers.return_value = [40, 41, 42, 43, 44, 45]
+        blk.start()
+        blk.process_signals([Signal({'address': 14}),
+                             Signal({'address': 10}),
+                             Signal({'address': 12})])
+        blk._client.read_registers.assert_called_once_with(registeraddress=10,
+                                                           functioncode=3,
+                                                           numberOfRegisters=6)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(len(notified), 3)
+        self.assertEqual(notified[0].values, [44, 45])
+        self.assertEqual(notified[0].params, {'registeraddress': 14,
+                                              'functioncode': 3,
+                                              'numberOfRegisters': 2})
+        self.assertEqual(notified[1].values, [40, 41])
+        self.assertEqual(notified[2].values, [42, 43])
+        blk.stop()
+
+    @patch('minimalmodbus.Instrument')
+    def test_max_read_registers(self, mock_client):
+        ''' Test that combined reads are split at max_read_registers '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {
+            'function_name': 'read_holding_registers',
+            'address': '{{ $address }}',
+            'count': 2,
+            'combine_reads': True,
+            'max_read_registers': 4
+        })
+        blk._client.read_registers.side_effect = [[40, 41, 42, 43], [44, 45]]
+        blk.start()
+        blk.process_signals([Signal({'address': 14}),
+                             Signal({'address': 10}),
+                             Signal({'address': 12})])
+        self.assertEqual(blk._client.read_registers.call_args_list, [
+            call(registeraddress=10, functioncode=3, numberOfRegisters=4),
+            call(registeraddress=14, functioncode=3, numberOfRegisters=2)])
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(notified[0].values, [44, 45])
+        self.assertEqual(notified[1].values, [40, 41])
+        self.assertEqual(notified[2].values, [42, 43])
+        blk.stop()
+
+    @patch('minimalmodbus.Instrument')
+    def test_max_read_registers_below_one(self, mock_client):
+        ''' Test that a maximum below one is raised to one register '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {
+            'function_name': 'read_holding_registers',
+            'address': '{{ $address }}',
+            'combine_reads': True,
+            'max_read_registers': 0
+        })
+        self.assertEqual(blk._max_read_registers, 1)
+        blk._client.read_registers.side_effect = [[40], [41]]
+        blk.start()
+        blk.process_signals([Signal({'address': 10}),
+                             Signal({'address': 11})])
+        self.assertEqual(blk._client.read_registers.call_args_list, [
+            call(registeraddress=10, functioncode=3, numberOfRegisters=1),
+            call(registeraddress=11, functioncode=3, numberOfRegisters=1)])
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual([signal.values for signal in notified], [[40], [41]])
+        blk.stop()
+
+    @patch('minimalmodbus.Instrument')
+    def test_fixed_value(self, mock_client):
+        ''' Test that a value without an expression is evaluated once '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {
+            'function_name': 'write_multiple_holding_registers',
+            'value': [1, 2, 3]
+        })
+        self.assertTrue(blk._value_is_fixed)
+        blk._client.write_registers.return_value = [42]
+        blk.start()
+        blk.process_signals([Signal()])
+        blk._client.write_registers.assert_called_once_with(
+            registeraddress=0, functioncode=16, value=[1, 2, 3])
+        blk.stop()
+
     @patch('minimalmodbus.Instrument')
     def test_invalid_value_property(self, mock_client):
         ''' Test when value is invalid '''
@@ -88,6 +215,8 @@ class TestModbusRTU(NIOBlockTestCase):
         with self.assertRaises(Exception):
             blk.process_signals([Signal()])
         self.assertEqual(blk._client.write_bit.call_count, 0)
+        # The failed signal doesn't keep holding its lock slot
+        self.assertEqual(self._free_lock_slots(blk), blk._max_locks)
         self.assertFalse(len(self.last_notified[DEFAULT_TERMINAL]))
         blk.stop()
 
@@ -125,20 +254,30 @@ class TestModbusRTU(NIOBlockTestCase):
         self.assertEqual(mock_client.call_count, 2)
         blk.stop()
 
+    @staticmethod
+    def _free_lock_slots(blk):
+        ''' Count how many lock slots are available without using them '''
+        free = 0
+        while blk._lock_slots.acquire(blocking=False):
+            free += 1
+        for _ in range(free):
+            blk._lock_slots.release()
+        return free
+
     @patch('minimalmodbus.Instrument')
     def test_lock_counter(self, mock_client):
-        ''' Test that the num_locks counter works '''
+        ''' Test that a lock slot is held while a signal is processed '''
         blk = ModbusRTU()
 
         def _process_signal(signal):
-            self.assertEqual(blk._num_locks, 1)
+            self.assertEqual(self._free_lock_slots(blk), blk._max_locks - 1)
             return signal
         blk._process_signal = _process_signal
         self.configure_block(blk, {})
         blk.start()
-        self.assertEqual(blk._num_locks, 0)
+        self.assertEqual(self._free_lock_slots(blk), blk._max_locks)
         blk.process_signals([Signal()])
-        self.assertEqual(blk._num_locks, 0)
+        self.assertEqual(self._free_lock_slots(blk), blk._max_locks)
         self.assertEqual(len(self.last_notified[DEFAULT_TERMINAL]), 1)
         blk.stop()
 
@@ -148,12 +287,44 @@ class TestModbusRTU(NIOBlockTestCase):
         blk = ModbusRTU()
         self.configure_block(blk, {})
         # Put the block in a state where all the max locks is reached
-        blk._num_locks = blk._max_locks
+        for _ in range(blk._max_locks):
+            blk._lock_slots.acquire()
         blk.start()
         blk.process_signals([Signal()])
         self.assertEqual(len(self.last_notified[DEFAULT_TERMINAL]), 0)
         blk.stop()
 
+    @patch('minimalmodbus.Instrument')
+    def test_low_latency_mode(self, mock_client):
+        ''' Test that the serial port is put in low latency mode '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {})
+        blk._client.serial.set_low_latency_mode.assert_called_once_with(True)
+        # Ports that don't support it are still usable
+        blk.logger.debug = MagicMock()
+        blk._client.serial.set_low_latency_mode.side_effect = ValueError
+        blk._set_low_latency()
+        blk.logger.debug.assert_called_once_with(
+            'Serial port does not support low latency mode', exc_info=True)
+        # Unexpected errors are not hidden
+        blk._client.serial.set_low_latency_mode.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            blk._set_low_latency()
+
+    @patch('minimalmodbus.Instrument')
+    def test_low_latency_mode_closed_port(self, mock_client):
+        ''' Test that a retry doesn't configure a port closed for reconnect '''
+        blk = ModbusRTU()
+        self.configure_block(blk, {})
+        serial = mock_client.return_value.serial
+        serial.set_low_latency_mode.assert_called_once_with(True)
+        # The cached port is closed and has no file descriptor to configure
+        serial.is_open = False
+        serial.set_low_latency_mode.side_effect = TypeError
+        blk.before_retry()
+        serial.close.assert_called_once_with()
+        serial.set_low_latency_mode.assert_called_once_with(True)
+
     @patch('minimalmodbus.Instrument')
     def test_failed_close(self, mock_client):
         blk = ModbusRTU()
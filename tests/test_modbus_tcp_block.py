@@ -1,24 +1,17 @@
-from threading import Event
+import socket
+from importlib.util import find_spec
+from threading import Event, Semaphore
 from unittest import skipUnless
-from unittest.mock import patch, MagicMock
-from time import sleep
+from unittest.mock import ANY, call, patch, MagicMock
 
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
 from nio.signal.base import Signal
 from nio.util.threading import spawn
 
-pymodbus_available = True
-try:
-    import pymodbus
-except ImportError:
-    pymodbus_available = False
-
-try:
-    from ..modbus_tcp_block import ModbusTCP
-except Exception as e:
-    print('Error importing ModbusTCP block: {}'.format(e))
-    pass
+pymodbus_available = find_spec('pymodbus') is not None
+if pymodbus_available:
+    from ..modbus_tcp_block import ModbusTCP, EXCEPTION_DETAILS
 
 
 class SampleResponse():
@@ -27,6 +20,29 @@ class SampleResponse():
         self.value = value
 
 
+def fake_connection(client, results=None):
+    ''' Make a client mock open a socket on connect and drop it on close
+
+    Args:
+        client (MagicMock): The mocked ModbusTcpClient.
+        results (list): Result of each connect() call in turn, every call
+            succeeds if this is None.
+    '''
+    client.socket = None
+
+    def connect():
+        if results is not None and not results.pop(0):
+            return False
+        client.socket = MagicMock()
+        return True
+
+    def close():
+        client.socket = None
+    client.connect.side_effect = connect
+    client.close.side_effect = close
+    return client
+
+
 @skipUnless(pymodbus_available, 'pymodbus is not available!!')
 class TestModbusTCP(NIOBlockTestCase):
 
@@ -37,11 +53,12 @@ class TestModbusTCP(NIOBlockTestCase):
         self.configure_block(blk, {})
         mock_client.assert_called_once_with('127.0.0.1', port=502, timeout=1)
         # Simulate some response from the modbus read
-        blk._client(blk.host(),blk.port()).read_coils.return_value = SampleResponse()
+        client = blk._client(blk.host(), blk.port())
+        client.read_coils.return_value = SampleResponse()
         blk.start()
         # Read once and assert output
         blk.process_signals([Signal()])
-        blk._client(blk.host(),blk.port()).read_coils.assert_called_once_with(
+        client.read_coils.assert_called_once_with(
             address=0, count=1, unit=1)
         self.assertTrue(len(self.last_notified[DEFAULT_TERMINAL]))
         self.assertEqual(
@@ -57,6 +74,69 @@ class TestModbusTCP(NIOBlockTestCase):
                                             port=502,
                                             timeout=3.14)
 
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_socket_options(self, mock_client):
+        ''' Test that new connections disable Nagle and enable keepalive '''
+        client = fake_connection(mock_client.return_value)
+        client.read_coils.return_value = SampleResponse()
+        blk = ModbusTCP()
+        self.configure_block(blk, {})
+        # The connection is only made once there is a request to send
+        client.connect.assert_not_called()
+        blk.start()
+        blk.process_signals([Signal()])
+        client.connect.assert_called_once_with()
+        client.socket.setsockopt.assert_any_call(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.socket.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            client.socket.setsockopt.assert_any_call(
+                socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_socket_options_after_failed_connect(self, mock_client):
+        ''' Test that a socket opened after a failed connect gets options '''
+        # The device can't be reached for the first request
+        client = fake_connection(mock_client.return_value, [False, True])
+        client.read_coils.return_value = SampleResponse()
+        blk = ModbusTCP()
+        self.configure_block(blk, {'retry_options': {'multiplier': 0}})
+        blk.start()
+        blk.process_signals([Signal()])
+        blk.process_signals([Signal()])
+        # The retry connects before the request and sets options only once
+        self.assertEqual(client.connect.call_count, 2)
+        sock = client.socket
+        sock.setsockopt.assert_any_call(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.assertEqual(sock.setsockopt.call_args_list.count(
+            call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)), 1)
+        # Keepalive matters most for a device that was down at startup
+        sock.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt.assert_any_call(
+                socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        self.assertEqual(client.read_coils.call_count, 2)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_failed_connect_skips_request(self, mock_client):
+        ''' Test that a failed connect fails the attempt straight away '''
+        client = fake_connection(mock_client.return_value, [False, False])
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'retry_options': {'multiplier': 0, 'max_retry': 1}})
+        blk.start()
+        blk.process_signals([Signal()])
+        # One connect per attempt and no request without a connection
+        self.assertEqual(client.connect.call_count, 2)
+        client.read_coils.assert_not_called()
+        self.assert_num_signals_notified(1)
+        blk.stop()
+
     @patch('pymodbus.client.sync.ModbusTcpClient')
     def test_enrich_signals_mixin(self, mock_client):
         ''' Test that read_coils is called with default configuration '''
@@ -64,11 +144,12 @@ class TestModbusTCP(NIOBlockTestCase):
         self.configure_block(blk, {"enrich": {"exclude_existing": False}})
         self.assertEqual(mock_client.call_count, 1)
         # Simulate some response from the modbus read
-        blk._client(blk.host(),blk.port()).read_coils.return_value = SampleResponse()
+        client = blk._client(blk.host(), blk.port())
+        client.read_coils.return_value = SampleResponse()
         blk.start()
         # Read once and assert output
         blk.process_signals([Signal({"input": "signal"})])
-        blk._client(blk.host(),blk.port()).read_coils.assert_called_once_with(
+        client.read_coils.assert_called_once_with(
             address=0, count=1, unit=1)
         self.assertTrue(len(self.last_notified[DEFAULT_TERMINAL]))
         self.assertDictEqual(
@@ -79,6 +160,22 @@ class TestModbusTCP(NIOBlockTestCase):
             })
         blk.stop()
 
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_connection_reused(self, mock_client):
+        ''' Test that every signal is read over the same connection '''
+        client = fake_connection(mock_client.return_value)
+        blk = ModbusTCP()
+        self.configure_block(blk, {})
+        client.read_coils.return_value = SampleResponse()
+        blk.start()
+        for _ in range(20):
+            blk.process_signals([Signal()])
+        self.assertEqual(client.read_coils.call_count, 20)
+        self.assertEqual(mock_client.call_count, 1)
+        client.connect.assert_called_once_with()
+        client.close.assert_not_called()
+        blk.stop()
+
     @patch('pymodbus.client.sync.ModbusTcpClient')
     def test_multiple_hosts(self, mock_client):
         ''' Test that read_coils is called for each client'''
@@ -107,6 +204,204 @@ class TestModbusTCP(NIOBlockTestCase):
         self.assertEqual(self.last_notified[DEFAULT_TERMINAL][1].value, '2')
         blk.stop()
 
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_multiple_units(self, mock_client):
+        ''' Test that units on the same host share one client '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            "host": "{{ $host }}", "unit_id": "{{ $unit }}"})
+        self.assertEqual(mock_client.call_count, 0)
+        client = mock_client.return_value
+        client.read_coils.return_value = SampleResponse()
+        blk.start()
+        blk.process_signals([Signal({"host": "host1", "unit": 1})])
+        blk.process_signals([Signal({"host": "host1", "unit": 2})])
+        # Both units are read over the one connection to the host
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertIs(blk._client("host1", blk.port()), client)
+        client.read_coils.assert_any_call(address=0, count=1, unit=1)
+        client.read_coils.assert_any_call(address=0, count=1, unit=2)
+        self.assertEqual(len(self.last_notified[DEFAULT_TERMINAL]), 2)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_combine_reads(self, mock_client):
+        ''' Test that adjacent reads are combined into one request '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'address': '{{ $address }}',
+            'combine_reads': True})
+        client = blk._client(blk.host(), blk.port())
+        response = SampleResponse()
+        response.bits = [True, False, True, False, False, False, False, False]
+        response.byte_count = 1
+        client.read_coils.return_value = response
+        blk.start()
+        blk.process_signals([Signal({'address': 2}),
+                             Signal({'address': 0}),
+                             Signal({'address': 1})])
+        client.read_coils.assert_called_once_with(
+            address=0, count=3, unit=1)
+        # Each signal gets its own slice of the response, in order
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(len(notified), 3)
+        self.assertEqual(notified[0].bits, [True])
+        self.assertEqual(notified[0].params,
+                         {'address': 2, 'count': 1, 'unit': 1})
+        self.assertEqual(notified[1].bits, [True])
+        self.assertEqual(notified[2].bits, [False])
+        self.assertEqual(notified[0].byte_count, 1)
+        # The pymodbus response itself is not modified
+        self.assertEqual(len(response.bits), 8)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_combine_contiguous_reads(self, mock_client):
+        ''' Test that a run of contiguous addresses is read at once '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'address': '{{ $address }}',
+            'combine_reads': True})
+        client = blk._client(blk.host(), blk.port())
+        response = SampleResponse()
+        response.bits = [address % 2 == 0 for address in range(16)]
+        client.read_coils.return_value = response
+        blk.start()
+        blk.process_signals([Signal({'address': address})
+                             for address in range(10)])
+        client.read_coils.assert_called_once_with(
+            address=0, count=10, unit=1)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual([signal.bits for signal in notified],
+                         [[address % 2 == 0] for address in range(10)])
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_max_read_registers(self, mock_client):
+        ''' Test that combined register reads are split at the maximum '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'function_name': 'read_holding_registers',
+            'address': '{{ $address }}',
+            'combine_reads': True,
+            'max_read_registers': 2})
+        client = blk._client(blk.host(), blk.port())
+        first, second = SampleResponse(), SampleResponse()
+        first.registers = [40, 41]
+        second.registers = [42]
+        client.read_holding_registers.side_effect = [first, second]
+        blk.start()
+        blk.process_signals([Signal({'address': 0}),
+                             Signal({'address': 1}),
+                             Signal({'address': 2})])
+        self.assertEqual(client.read_holding_registers.call_count, 2)
+        client.read_holding_registers.assert_any_call(
+            address=0, count=2, unit=1)
+        client.read_holding_registers.assert_any_call(
+            address=2, count=1, unit=1)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual([signal.registers for signal in notified],
+                         [[40], [41], [42]])
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_max_read_registers_below_one(self, mock_client):
+        ''' Test that a maximum below one still reads every signal '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'function_name': 'read_holding_registers',
+            'address': '{{ $address }}',
+            'combine_reads': True,
+            'max_read_registers': 0})
+        client = blk._client(blk.host(), blk.port())
+        first, second = SampleResponse(), SampleResponse()
+        first.registers = [40]
+        second.registers = [41]
+        client.read_holding_registers.side_effect = [first, second]
+        blk.start()
+        blk.process_signals([Signal({'address': 0}),
+                             Signal({'address': 1})])
+        self.assertEqual(client.read_holding_registers.call_count, 2)
+        client.read_holding_registers.assert_any_call(
+            address=0, count=1, unit=1)
+        client.read_holding_registers.assert_any_call(
+            address=1, count=1, unit=1)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual([signal.registers for signal in notified],
+                         [[40], [41]])
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_combine_reads_in_batches(self, mock_client):
+        ''' Test that a large list of reads is split into a few requests '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'function_name': 'read_input_registers',
+            'address': '{{ $address }}',
+            'combine_reads': True,
+            'max_read_registers': 10})
+        client = blk._client(blk.host(), blk.port())
+
+        def read_input_registers(address, count, unit):
+            response = SampleResponse()
+            response.registers = list(range(address, address + count))
+            response.byte_count = 2 * count
+            return response
+        client.read_input_registers.side_effect = read_input_registers
+        blk.start()
+        blk.process_signals([Signal({'address': address})
+                             for address in range(50)])
+        self.assertEqual(client.read_input_registers.call_count, 5)
+        for address in range(0, 50, 10):
+            client.read_input_registers.assert_any_call(
+                address=address, count=10, unit=1)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual([signal.registers for signal in notified],
+                         [[address] for address in range(50)])
+        # The byte count matches a read of a single register
+        self.assertEqual({signal.byte_count for signal in notified}, {2})
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_combine_duplicate_reads(self, mock_client):
+        ''' Test that identical reads in a batch share one request '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {'combine_reads': True})
+        client = blk._client(blk.host(), blk.port())
+        response = SampleResponse()
+        response.bits = [True, False, False, False, False, False, False, False]
+        client.read_coils.return_value = response
+        blk.start()
+        blk.process_signals([Signal(), Signal(), Signal()])
+        client.read_coils.assert_called_once_with(
+            address=0, count=1, unit=1)
+        notified = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(len(notified), 3)
+        for signal in notified:
+            self.assertEqual(signal.bits, [True])
+            self.assertEqual(signal.params,
+                             {'address': 0, 'count': 1, 'unit': 1})
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_combine_reads_around_writes(self, mock_client):
+        ''' Test that reads are not combined across a write '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            'function_name': '{{ $function }}',
+            'combine_reads': True})
+        client = blk._client(blk.host(), blk.port())
+        client.read_coils.return_value = SampleResponse()
+        client.write_coil.return_value = SampleResponse()
+        blk.start()
+        blk.process_signals([Signal({'function': 'read_coils'}),
+                             Signal({'function': 'write_single_coil'}),
+                             Signal({'function': 'read_coils'})])
+        self.assertEqual(client.read_coils.call_count, 2)
+        self.assertEqual(client.write_coil.call_count, 1)
+        self.assertEqual(len(self.last_notified[DEFAULT_TERMINAL]), 3)
+        blk.stop()
+
     @patch('pymodbus.client.sync.ModbusTcpClient')
     def test_write_coil(self, mock_client):
         ''' Test write_coil function '''
@@ -114,12 +409,13 @@ class TestModbusTCP(NIOBlockTestCase):
         self.configure_block(blk, {'function_name': 'write_coil'})
         self.assertEqual(mock_client.call_count, 1)
         # Simulate some response from the modbus read
-        blk._client(blk.host(),blk.port()).write_coil.return_value = SampleResponse()
+        client = blk._client(blk.host(), blk.port())
+        client.write_coil.return_value = SampleResponse()
         blk.start()
         # Read once and assert output
         blk.process_signals([Signal()])
-        self.assertEqual(blk._client(blk.host(),blk.port()).write_coil.call_count, 1)
-        blk._client(blk.host(),blk.port()).write_coil.assert_called_once_with(
+        self.assertEqual(client.write_coil.call_count, 1)
+        client.write_coil.assert_called_once_with(
             address=0, value=True, unit=1)
         self.assertTrue(len(self.last_notified[DEFAULT_TERMINAL]))
         self.assertEqual(
@@ -133,12 +429,13 @@ class TestModbusTCP(NIOBlockTestCase):
         self.configure_block(blk, {'function_name': '{{ $function }}'})
         self.assertEqual(mock_client.call_count, 1)
         # Simulate some response from the modbus read
-        blk._client(blk.host(),blk.port()).write_coils.return_value = SampleResponse()
+        client = blk._client(blk.host(), blk.port())
+        client.write_coils.return_value = SampleResponse()
         blk.start()
         # Read once and assert output
         blk.process_signals([Signal({'function': 'write_multiple_coils'})])
-        self.assertEqual(blk._client(blk.host(),blk.port()).write_coils.call_count, 1)
-        blk._client(blk.host(),blk.port()).write_coils.assert_called_once_with(
+        self.assertEqual(client.write_coils.call_count, 1)
+        client.write_coils.assert_called_once_with(
             address=0, values=True, unit=1)
         self.assertTrue(len(self.last_notified[DEFAULT_TERMINAL]))
         self.assertEqual(
@@ -166,23 +463,56 @@ class TestModbusTCP(NIOBlockTestCase):
     @patch('pymodbus.client.sync.ModbusTcpClient')
     def test_execute_retry_success(self, mock_client):
         ''' Test behavior when execute retry works '''
+        client = fake_connection(mock_client.return_value)
         blk = ModbusTCP()
         self.configure_block(blk, {'retry_options': {'multiplier': 0}})
         self.assertEqual(mock_client.call_count, 1)
         # Simulate an exception and then a success.
-        blk._client(blk.host(),blk.port()).read_coils.side_effect = \
-            [Exception, SampleResponse()]
+        client.read_coils.side_effect = [Exception, SampleResponse()]
         blk.start()
         # Read once and then retry.
         blk.process_signals([Signal()])
         # Modbus function is called twice. Once for the retry.
-        self.assertEqual(blk._client(blk.host(),blk.port()).read_coils.call_count, 2)
+        self.assertEqual(client.read_coils.call_count, 2)
         # A signal is output because of successful retry.
         self.assertTrue(bool(len(self.last_notified[DEFAULT_TERMINAL])))
         self.assertEqual(
             self.last_notified[DEFAULT_TERMINAL][0].value, 'default')
-        # The retry created a new client before calling modbus function again.
+        # The retry reconnected the same client instead of creating a new one
+        self.assertEqual(mock_client.call_count, 1)
+        client.close.assert_called_once_with()
+        self.assertEqual(client.connect.call_count, 2)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_retry_only_reconnects_failed_host(self, mock_client):
+        ''' Test that a retry leaves clients for other hosts connected '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {
+            "host": "{{ $host }}",
+            "retry_options": {"multiplier": 0}})
+        # Give each host its own client
+        def new_client(*args, **kwargs):
+            client = fake_connection(MagicMock())
+            client.read_coils.return_value = SampleResponse()
+            return client
+        mock_client.side_effect = new_client
+        blk.start()
+        # Connect to both hosts
+        blk.process_signals([Signal({"host": "host1"})])
+        blk.process_signals([Signal({"host": "host2"})])
+        self.assertEqual(mock_client.call_count, 2)
+        host1_client = blk._client("host1", blk.port())
+        host2_client = blk._client("host2", blk.port())
+        # Fail once on host1 and then succeed
+        host1_client.read_coils.side_effect = [Exception, SampleResponse()]
+        blk.process_signals([Signal({"host": "host1"})])
+        # Only host1 reconnects and host2 is untouched
         self.assertEqual(mock_client.call_count, 2)
+        host1_client.close.assert_called_once_with()
+        self.assertEqual(host1_client.connect.call_count, 2)
+        host2_client.close.assert_not_called()
+        self.assertEqual(host2_client.connect.call_count, 1)
         blk.stop()
 
     @patch('pymodbus.client.sync.ModbusTcpClient')
@@ -206,11 +536,15 @@ class TestModbusTCP(NIOBlockTestCase):
         blk = ModbusTCP()
         self.configure_block(blk, {})
         event = Event()
+        done = Semaphore(0)
+        calls = []
 
         def _process_signals(signals):
+            calls.append(signals)
             event.wait()
             blk.notify_signals(signals)
-        blk._locked_process_signals = MagicMock(side_effect=_process_signals)
+            done.release()
+        blk._locked_process_signals = _process_signals
         blk.logger = MagicMock()
         blk.start()
         for _ in range(5):
@@ -219,29 +553,68 @@ class TestModbusTCP(NIOBlockTestCase):
         # The last signal logs a warning because limit lock is reached
         self.assertEqual(blk.logger.warning.call_count, 1)
         # Only the first signal gets to call process signals because of lock
-        self.assertEqual(blk._locked_process_signals.call_count, 1)
+        self.assertEqual(len(calls), 1)
         # Now let the signals waiting for lock get processed and notify them
         event.set()
-        sleep(0.1)
+        for _ in range(5):
+            self.assertTrue(done.acquire(timeout=1))
         self.assert_num_signals_notified(10)
         blk.stop()
 
-    def test_exception_detail_codes(self):
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_no_signals(self, mock_client):
+        ''' Test that an empty list of signals doesn't take the lock '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {})
+        blk.execute_with_lock = MagicMock()
+        blk.start()
+        blk.process_signals([])
+        self.assertEqual(blk.execute_with_lock.call_count, 0)
+        self.assert_num_signals_notified(0)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_notify_once_per_list(self, mock_client):
+        ''' Test that a list of signals is notified with a single call '''
+        blk = ModbusTCP()
+        self.configure_block(blk, {})
+        blk._client(blk.host(), blk.port()).read_coils.return_value = \
+            SampleResponse()
+        blk.notify_signals = MagicMock()
+        blk.start()
+        blk.process_signals([Signal() for _ in range(10)])
+        blk.notify_signals.assert_called_once_with(ANY)
+        self.assertEqual(len(blk.notify_signals.call_args[0][0]), 10)
+        blk.stop()
+
+    @patch('pymodbus.client.sync.ModbusTcpClient')
+    def test_exception_detail_codes(self, mock_client):
         ''' Test that each exception code sets exception_details '''
         blk = ModbusTCP()
+        self.configure_block(blk, {})
+        client = blk._client(blk.host(), blk.port())
+        blk.start()
+        for code in (1, 2, 3, 4, 5, 6, 7, 8, 10, 11):
+            with self.subTest(code=code):
+                resp = SampleResponse()
+                resp.exception_code = code
+                client.read_coils.return_value = resp
+                blk.process_signals([Signal()])
+                self.assertEqual(
+                    self.last_notified[DEFAULT_TERMINAL][-1].exception_details,
+                    EXCEPTION_DETAILS[code])
         # Check that the message is different for each code
-        signal = Signal()
-        prev_details = ''
-        for code in [1, 2, 3, 4, 5, 6, 7, 8, 10, 11]:
-            signal.exception_code = code
-            blk._check_exceptions(signal)
-            self.assertNotEqual(signal.exception_details, prev_details)
-            prev_details = signal.exception_details
+        self.assertEqual(len(set(EXCEPTION_DETAILS.values())),
+                         len(EXCEPTION_DETAILS))
         # Check unkown status code does not give details
-        signal = Signal()
-        signal.exception_code = 12
-        blk._check_exceptions(signal)
+        resp = SampleResponse()
+        resp.exception_code = 12
+        client.read_coils.return_value = resp
+        blk.process_signals([Signal()])
+        signal = self.last_notified[DEFAULT_TERMINAL][-1]
+        self.assertEqual(signal.exception_code, 12)
         self.assertFalse(hasattr(signal, 'exception_details'))
+        blk.stop()
 
     @patch('pymodbus.client.sync.ModbusTcpClient')
     def test_host_and_port_from_signal(self, mock_client):